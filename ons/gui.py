@@ -99,6 +99,44 @@ class ANMX_gui(bpy.types.Panel):
         col.prop(access, "use_xray")
         col.prop(access, "use_flat")
         col.prop(access, "in_front")
+
+        layout.separator(factor=0.2)
+        col = layout.column(align=True)
+        col.prop(access, "roi_mode")
+        if access.roi_mode == "VGROUP":
+            # Search the groups of a group member, the active object may not be one
+            members = access.get_onion_group()
+            member = obj if obj in members else (members[0] if members else None)
+            if member:
+                col.prop_search(access, "roi_vertex_group", member, "vertex_groups", text="Vertex Group")
+            else:
+                col.prop(access, "roi_vertex_group")
+        if access.roi_mode != "ALL" and bake_info.get("roi_empty"):
+            col.label(text="Region is empty, nothing baked", icon='ERROR')
+        if access.roi_mode != "ALL" and bake_info.get("roi_skipped"):
+            col.label(text="Topology changes, %d frames left out" % len(bake_info["roi_skipped"]), icon='INFO')
+
+        layout.separator(factor=0.2)
+        col = layout.column(heading="Bake", align=True)
+        col.prop(access, "bake_preset", text="Modifiers")
+        if access.bake_preset == "CUSTOM":
+            col.prop(access, "bake_limit_levels")
+            sub = col.row(align=True)
+            sub.active = access.bake_limit_levels
+            sub.prop(access, "bake_subsurf_levels")
+            col.prop(access, "bake_disabled_modifiers")
+
+        if access.onion_mode in {"PF", "INB"}:
+            col = layout.column(align=True)
+            col.prop(access, "use_sparse")
+            sub = col.column(align=True)
+            sub.active = access.use_sparse
+            sub.prop(access, "sparse_tolerance")
+            if access.use_sparse and "fallback" in bake_info:
+                if bake_info["fallback"]:
+                    col.label(text="Topology changes, all frames evaluated", icon='INFO')
+                else:
+                    col.label(text="Evaluated %d of %d frames (%d keys)" % (bake_info["sampled"], bake_info["total"], bake_info["keys"]), icon='INFO')
         
         layout.use_property_split = False
         layout.separator(factor=0.2)
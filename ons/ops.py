@@ -20,6 +20,29 @@ shader = gpu.shader.from_builtin('UNIFORM_COLOR')
 frame_data = dict([])
 batches = dict([])
 extern_data = dict([])
+bake_info = dict([])
+roi_data = dict([])
+
+# Modifier types that can be turned off while baking, they add or smooth geometry on top of the pose
+bake_modifier_types = [
+    ("SUBSURF", "Subdivision Surface", "Subdivision Surface modifiers"),
+    ("MULTIRES", "Multiresolution", "Multiresolution modifiers"),
+    ("SMOOTH", "Smooth", "Smooth modifiers"),
+    ("CORRECTIVE_SMOOTH", "Corrective Smooth", "Corrective Smooth modifiers"),
+    ("LAPLACIANSMOOTH", "Laplacian Smooth", "Laplacian Smooth modifiers"),
+    ("SOLIDIFY", "Solidify", "Solidify modifiers"),
+    ("BEVEL", "Bevel", "Bevel modifiers"),
+    ("WIREFRAME", "Wireframe", "Wireframe modifiers"),
+    ("REMESH", "Remesh", "Remesh modifiers"),
+    ]
+
+# Preset name: (modifier types to disable, subdivision level cap or -1 for untouched)
+# Corrective Smooth is left on, it fixes the armature deformation so turning it off changes the pose
+bake_presets = {
+    "FULL": (set(), -1),
+    "REDUCED": (set(), 0),
+    "NO_SMOOTH": ({"SUBSURF", "MULTIRES", "SMOOTH", "LAPLACIANSMOOTH", "SOLIDIFY", "BEVEL", "WIREFRAME", "REMESH"}, -1),
+    }
 
 # ################ #
 # Functions        #
@@ -39,20 +62,225 @@ def frame_get_set(_obj, frame):
     mat = Matrix(_obj.matrix_world)
     mesh.transform(mat)
     mesh.update()
+
+    vertices = np.empty((len(mesh.vertices), 3), 'f')
+    mesh.vertices.foreach_get("co", np.reshape(vertices, len(mesh.vertices) * 3))
+
+    # The region of interest triangles are worked out once, later frames only gather vertices
+    roi = "count" in roi_data and len(vertices) == roi_data["count"]
+    if "face_mask" in roi_data:
+        roi = roi and len(mesh.polygons) == len(roi_data["face_mask"])
+
+    # The topology changed since the region was picked, leave the frame out rather than show the whole group
+    if "count" in roi_data and not roi:
+        bake_info.setdefault("roi_skipped", set()).add(frame)
+        return None
+    if roi and "indices" in roi_data:
+        return [vertices[roi_data["verts"]], roi_data["indices"]]
+
     mesh.calc_loop_triangles()
     mesh.update()
 
-    vertices = np.empty((len(mesh.vertices), 3), 'f')
     indices = np.empty((len(mesh.loop_triangles), 3), 'i')
-
-    mesh.vertices.foreach_get("co", np.reshape(vertices, len(mesh.vertices) * 3))
     mesh.loop_triangles.foreach_get("vertices", np.reshape(indices, len(mesh.loop_triangles) * 3))
 
+    if roi:
+        if "face_mask" in roi_data:
+            # Triangles follow the face they come from, unselected faces between selected ones stay out
+            polys = np.empty(len(mesh.loop_triangles), 'i')
+            mesh.loop_triangles.foreach_get("polygon_index", polys)
+            keep = roi_data["face_mask"][polys]
+        else:
+            keep = roi_data["vert_mask"][indices].all(axis=1)
+        kept = indices[keep]
+        roi_data["verts"] = np.unique(kept)
+        remap = np.zeros(len(vertices), 'i')
+        remap[roi_data["verts"]] = np.arange(len(roi_data["verts"]), dtype='i')
+        roi_data["indices"] = remap[kept]
+        return [vertices[roi_data["verts"]], roi_data["indices"]]
+
     args = [vertices, indices]
 
     return args
 
 
+def compute_roi(group_objs):
+    """ Marks the vertices or faces of the joined group that belong to the region of interest,
+    returns the objects that take part in it, empty when the region is """
+    anmx = bpy.context.scene.anmx_data
+    roi_data.clear()
+    if anmx.roi_mode == "ALL":
+        return group_objs
+
+    depsgraph = bpy.context.evaluated_depsgraph_get()
+    count = 0
+    masks = []
+    roi_objs = []
+    # Same object order as join_meshes so the masks line up with the joined vertices and faces
+    for obj in group_objs:
+        if obj.type != 'MESH':
+            continue
+        eval_obj = obj.evaluated_get(depsgraph)
+        mesh = eval_obj.to_mesh()
+        mesh_verts = len(mesh.vertices)
+
+        if anmx.roi_mode == "VGROUP":
+            mask = np.zeros(len(mesh.vertices), bool)
+            vg = obj.vertex_groups.get(anmx.roi_vertex_group)
+            if vg:
+                # One lookup per vertex in the deform layer instead of walking every vertex's groups
+                bm = bmesh.new()
+                bm.from_mesh(mesh)
+                deform = bm.verts.layers.deform.active
+                if deform:
+                    mask = np.fromiter((v[deform].get(vg.index, 0.0) > 0 for v in bm.verts), bool, len(bm.verts))
+                bm.free()
+        else:
+            mask = np.zeros(len(mesh.polygons), bool)
+            mesh.polygons.foreach_get("select", mask)
+
+        eval_obj.to_mesh_clear()
+
+        # Objects outside the region are left out of the join, so they are never evaluated per frame
+        if mask.any():
+            count += mesh_verts
+            masks.append(mask)
+            roi_objs.append(obj)
+
+    # Nothing matched, report it rather than quietly baking the whole group
+    if not roi_objs:
+        bake_info["roi_empty"] = True
+        return roi_objs
+
+    roi_data["count"] = count
+    roi_data["vert_mask" if anmx.roi_mode == "VGROUP" else "face_mask"] = np.concatenate(masks)
+    return roi_objs
+
+
+def evaluate_frame(group_objs, frame):
+    """ Evaluates the joined onion group at the given frame, None when the region of interest does not fit it """
+    scn = bpy.context.scene
+    scn.frame_set(frame)
+    _obj = join_meshes(group_objs)
+    try:
+        return frame_get_set(_obj, frame)
+    finally:
+        bpy.data.objects.remove(_obj)
+
+
+def deform_keyframes(group_objs):
+    """ Collects the keyframes of everything that moves the group: the objects, their parents, armatures and shape keys """
+    sources = set()
+    pending = list(group_objs)
+    while pending:
+        obj = pending.pop()
+        if obj is None or obj in sources:
+            continue
+        sources.add(obj)
+        pending.append(obj.parent)
+        for mod in obj.modifiers if obj.type == 'MESH' else []:
+            if mod.type == 'ARMATURE':
+                pending.append(mod.object)
+
+    ids = list(sources) + [obj.data.shape_keys for obj in sources if obj.type == 'MESH' and obj.data.shape_keys]
+    keyframes = []
+    for id in ids:
+        if id.animation_data and id.animation_data.action:
+            for fc in id.animation_data.action.fcurves:
+                for k in fc.keyframe_points:
+                    keyframes.append(int(k.co[0]))
+    return np.unique(keyframes)
+
+
+def bake_sparse(group_objs, frames, keyframes, tolerance):
+    """ Evaluates the keyframes plus adaptive samples and interpolates the frames in between.
+    Returns False when the topology changes, evaluated frames are kept in frame_data either way """
+    first = frames[0]
+    last = frames[-1]
+
+    def evaluate(f):
+        arg = evaluate_frame(group_objs, f)
+        if arg is not None:
+            frame_data[str(f)] = arg
+        return arg
+
+    def same_topology(a, b):
+        if a is None or b is None:
+            return False
+        return a[0].shape == b[0].shape and np.array_equal(a[1], b[1])
+
+    samples = dict([])
+    for f in sorted(set(int(k) for k in keyframes if first <= k <= last) | {first, last}):
+        samples[f] = evaluate(f)
+    ref = samples[first]
+    if not all(same_topology(ref, samples[f]) for f in samples):
+        return False
+
+    def blend_error(a, b, f):
+        guess = samples[a][0] + (samples[b][0] - samples[a][0]) * ((f - a) / (b - a))
+        return np.max(np.linalg.norm(samples[f][0] - guess, axis=1)) if len(guess) else 0.0
+
+    # Heuristic: an interval is blended when the frames at 1/4, 1/2 and 3/4 all sit within the tolerance
+    # of the straight line, otherwise it is split at those frames. The midpoint alone misses a symmetric
+    # ease in/out, which crosses the line right there. Nothing bounds the error between the probes, motion
+    # that comes back to the same pose at all three slips through, which is why every key is sampled first.
+    intervals = list(zip(sorted(samples)[:-1], sorted(samples)[1:]))
+    while intervals:
+        a, b = intervals.pop()
+        if b - a < 2:
+            continue
+        probes = sorted({a + (b - a) // 4, (a + b) // 2, b - (b - a) // 4} - {a, b})
+        for m in probes:
+            if m not in samples:
+                samples[m] = evaluate(m)
+                if not same_topology(ref, samples[m]):
+                    return False
+        if max(blend_error(a, b, m) for m in probes) > tolerance:
+            bounds = [a] + probes + [b]
+            intervals.extend(zip(bounds[:-1], bounds[1:]))
+
+    # Fill the gaps between samples, one vectorized blend per interval
+    keys = sorted(samples)
+    for a, b in zip(keys[:-1], keys[1:]):
+        if b - a < 2:
+            continue
+        va = samples[a][0]
+        vb = samples[b][0]
+        t = ((np.arange(a + 1, b) - a) / (b - a)).astype('f')
+        block = va[None] + (vb - va)[None] * t[:, None, None]
+        for i, f in enumerate(range(a + 1, b)):
+            frame_data[str(f)] = [block[i], ref[1]]
+
+    bake_info["sampled"] = len(samples)
+    bake_info["keys"] = len([k for k in keyframes if first <= k <= last])
+    return True
+
+
+def override_modifiers(group_objs, restore):
+    """ Lowers subdivision levels and hides the chosen modifiers for baking, every change is appended to restore first """
+    anmx = bpy.context.scene.anmx_data
+    disabled = anmx.bake_disabled_modifiers
+    levels = anmx.bake_subsurf_levels if anmx.bake_limit_levels else -1
+
+    for obj in group_objs:
+        # Linked objects have read-only modifiers, those are baked as they are
+        if obj.library or not obj.is_editable:
+            continue
+        for mod in obj.modifiers:
+            if mod.type in disabled and mod.show_viewport:
+                restore.append((mod, "show_viewport", True))
+                mod.show_viewport = False
+            elif mod.type in {"SUBSURF", "MULTIRES"} and levels >= 0 and mod.levels > levels:
+                restore.append((mod, "levels", mod.levels))
+                mod.levels = levels
+
+
+def restore_modifiers(restore):
+    """ Puts back the modifier settings changed by override_modifiers """
+    for mod, attr, value in reversed(restore):
+        setattr(mod, attr, value)
+
+
 def set_to_active():
     """ Sets the onion skinning group as the active source for baking/drawing """
     scn = bpy.context.scene
@@ -80,6 +308,8 @@ def clear_active(clrRig):
     frame_data.clear()
     batches.clear()
     extern_data.clear()
+    bake_info.clear()
+    roi_data.clear()
 
     # Clear the onion group
     scn = bpy.context.scene
@@ -138,6 +368,8 @@ def bake_frames():
 
     frame_data.clear()
     extern_data.clear()
+    bake_info.clear()
+    roi_data.clear()
 
     if anmx.onion_mode == "PF":
         frames = range(start, end)
@@ -150,19 +382,37 @@ def bake_frames():
     else:
         frames = []
 
-    for f in frames:
-        scn.frame_set(f)
-        _obj = join_meshes(group_objs)
-        arg = frame_get_set(_obj, f)
-        frame_data[str(f)] = arg
-        bpy.data.objects.remove(_obj)
+    # Only the deformation is needed, so cheapen the modifier stack while baking
+    restore = []
+    try:
+        override_modifiers(group_objs, restore)
+        bake_objs = compute_roi(group_objs)
+        if not bake_objs:
+            frames = []
+
+        # Shared topology lets the in-betweens be interpolated instead of evaluated
+        sparse = anmx.use_sparse and anmx.onion_mode in {"PF", "INB"} and len(frames) > 2
+        if sparse:
+            # Rig, parent and shape key keys are required samples too, the probes alone can miss their motion
+            sparse = bake_sparse(bake_objs, frames, deform_keyframes(group_objs), anmx.sparse_tolerance)
+            bake_info["total"] = len(frames)
+            bake_info["fallback"] = not sparse
+
+        if not sparse:
+            for f in frames:
+                if str(f) in frame_data:
+                    continue
+                arg = evaluate_frame(bake_objs, f)
+                if arg is not None:
+                    frame_data[str(f)] = arg
+    finally:
+        restore_modifiers(restore)
+        scn.frame_set(curr)
 
     if anmx.onion_mode == "INB":
         extern_data.clear()
         for fkey in keyframes:
             extern_data[str(fkey)] = fkey
-
-    scn.frame_set(curr)
     
 
 # ################ #
@@ -177,6 +427,16 @@ class ANMX_data(PropertyGroup):
             bpy.ops.anim_extras.draw_meshes('INVOKE_DEFAULT')
         return
 
+    def preset_update(self, context):
+        if self.bake_preset == "CUSTOM":
+            return
+        disabled, levels = bake_presets[self.bake_preset]
+        self.bake_disabled_modifiers = disabled
+        self.bake_limit_levels = levels >= 0
+        if levels >= 0:
+            self.bake_subsurf_levels = levels
+        return
+
     def inFront(self, context):
         scn = bpy.context.scene
         # Set show_in_front for all objects in the onion group
@@ -197,6 +457,19 @@ class ANMX_data(PropertyGroup):
         ("INB", "Inbetweening", " Inbetweening, lets you see frames with direct keyframes in a different color than interpolated frames", 4)
         ]
 
+    presets = [
+        ("FULL", "Full Stack", "Bake with the modifiers as they are shown in the viewport", 1),
+        ("REDUCED", "No Subdivision", "Bake with subdivision levels set to 0", 2),
+        ("NO_SMOOTH", "No Subdivision/Smoothing", "Bake with subdivision, smoothing, solidify and other added geometry disabled. Corrective Smooth stays on", 3),
+        ("CUSTOM", "Custom", "Pick the modifiers and subdivision levels used while baking", 4),
+        ]
+
+    regions = [
+        ("ALL", "Whole Group", "Onion skins show every vertex of the group", 1),
+        ("VGROUP", "Vertex Group", "Onion skins only show the vertices in a vertex group", 2),
+        ("FACES", "Selected Faces", "Onion skins only show the faces selected in edit mode", 3),
+        ]
+
     # Onion Skinning Properties
     skin_count: bpy.props.IntProperty(name="Count", description="Number of frames we see in past and future", default=1, min=1)
     skin_step: bpy.props.IntProperty(name="Step", description="Number of frames to skip in conjuction with Count", default=1, min=1)
@@ -207,6 +480,20 @@ class ANMX_data(PropertyGroup):
     in_front: bpy.props.BoolProperty(name="In Front", description="Draws the selected object in front of the onion skinning", default=False, update=inFront)
     toggle: bpy.props.BoolProperty(name="Draw", description="Toggles onion skinning on or off", default=False, update=toggle_update)
     
+    # Bake settings, modifiers are only changed during baking and restored afterwards
+    bake_preset: bpy.props.EnumProperty(name="Bake Preset", description="Modifier settings used while baking the onion skins", items=presets, default="FULL", update=preset_update)
+    bake_disabled_modifiers: bpy.props.EnumProperty(name="Disable", description="Modifier types to disable while baking", items=bake_modifier_types, options={'ENUM_FLAG'}, default=set())
+    bake_limit_levels: bpy.props.BoolProperty(name="Limit Subdivision", description="Lower subdivision and multiresolution levels while baking", default=False)
+    bake_subsurf_levels: bpy.props.IntProperty(name="Levels", description="Maximum subdivision levels used while baking", default=0, min=0, max=6)
+
+    # Sparse baking, only used for Per-Frame and Inbetweening
+    use_sparse: bpy.props.BoolProperty(name="Sparse Bake", description="Only evaluate keyframes and adaptive samples, frames in between are interpolated. Needs the same topology on every frame", default=False)
+    sparse_tolerance: bpy.props.FloatProperty(name="Tolerance", description="Distance the interpolation may stray from the sampled frames before more frames are sampled. Checked at sample frames only, so it is a target rather than a guarantee. Motion from drivers or constraints is not keyed and can be missed", default=0.001, min=0.0, precision=4, subtype='DISTANCE')
+
+    # Region of interest, limits the baked and drawn onion skins to part of the group
+    roi_mode: bpy.props.EnumProperty(name="Region", description="Part of the group used for the onion skins", items=regions, default="ALL")
+    roi_vertex_group: bpy.props.StringProperty(name="Vertex Group", description="Vertex group the onion skins are limited to, looked up by name on every object of the group", default="")
+
     # Linked settings
     is_linked: bpy.props.BoolProperty(name="Is linked", default=False)
     link_parent: bpy.props.StringProperty(name="Link Parent", default="")